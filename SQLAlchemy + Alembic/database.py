@@ -1,60 +1,286 @@
-from collections.abc import Sequence
-from os import getenv
+from collections.abc import Hashable, Iterator, Mapping, Sequence
+from functools import cache
+from itertools import batched
+from os import environ
+from time import monotonic
+from typing import Any
 
-from sqlalchemy import Select, create_engine
-from sqlalchemy.orm import Session
+import orjson
+from sqlalchemy import Select, create_engine, insert, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import (
+    DeclarativeBase,
+    InstrumentedAttribute,
+    Session,
+    load_only,
+    sessionmaker,
+)
+from sqlalchemy.orm.interfaces import ORMOption
 
 
+@cache  # 環境変数はプロセス中で変わらない前提で、解決した URL を使い回す
 def get_database_url(
     scheme: str = "postgresql+psycopg",
     dbname: str = "alembic",
     default: str | None = None,
 ) -> str:
-    DATABASE_URL = getenv("DATABASE_URL")
+    DATABASE_URL = environ.get("DATABASE_URL")
     if DATABASE_URL:
         return DATABASE_URL.replace("postgresql://", f"{scheme}://")
 
-    DATABASE_HOSTNAME = getenv("DATABASE_HOSTNAME")
-    DATABASE_USERNAME = getenv("DATABASE_USERNAME")
-    DATABASE_PASSWORD = getenv("DATABASE_PASSWORD")
+    DATABASE_HOSTNAME = environ.get("DATABASE_HOSTNAME")
+    DATABASE_USERNAME = environ.get("DATABASE_USERNAME")
+    DATABASE_PASSWORD = environ.get("DATABASE_PASSWORD")
     if DATABASE_HOSTNAME and DATABASE_USERNAME and DATABASE_PASSWORD:
         return f"{scheme}://{DATABASE_USERNAME}:{DATABASE_PASSWORD}@{DATABASE_HOSTNAME}/{dbname}"
 
     return default or f"{scheme}://postgres@localhost/{dbname}"
 
 
-engine = create_engine(get_database_url())
+# コネクションプールの設定
+# - pool_pre_ping: 切断済みの接続を使う前に検知する
+# - pool_use_lifo: 直近に使った (温まっている) 接続から再利用する
+# - prepare_threshold: 同じクエリが 5 回実行されたら prepared statement にする
+# - jit=off: 短いクエリで JIT コンパイルのコストを払わない
+# - json_serializer / json_deserializer: JSONB の変換に標準の json より速い orjson を使う
+# - pool_size / max_overflow: 同期・非同期のエンジンはプールを別々に持つので、
+#   1 プロセスの最大接続数は両者の合計 (20 + 20 + 10 + 10 = 60) になる。
+#   PostgreSQL の既定の max_connections=100 を超えないよう、
+#   非同期側は小さめにして合計を抑えている
+ENGINE_OPTIONS: dict[str, Any] = {
+    "pool_size": 20,
+    "max_overflow": 20,
+    "pool_recycle": 1800,
+    "pool_pre_ping": True,
+    "pool_use_lifo": True,
+    "connect_args": {"prepare_threshold": 5, "options": "-c jit=off"},
+    "json_serializer": lambda obj: orjson.dumps(obj).decode(),
+    "json_deserializer": orjson.loads,
+}
 
+engine = create_engine(get_database_url(), **ENGINE_OPTIONS)
 
-def fetch_all[T](stmt: Select[tuple[T]]) -> Sequence[T]:
-    with Session(engine) as session:
+# fetch_* (読み取り) と insert_many / update_many (書き込み) で共用するセッションファクトリ
+# - 書き込みは SessionLocal.begin() で1トランザクションにまとめ、抜けるときに COMMIT する
+# - execute で直接 SQL を発行するだけなので autoflush は不要
+# - commit 後も取得済みのオブジェクトの属性を参照できるよう expire_on_commit は切る
+SessionLocal: sessionmaker[Session] = sessionmaker(
+    engine, autoflush=False, expire_on_commit=False
+)
+
+# イベントループ上から使うための非同期エンジン (psycopg 3 は async にも対応している)
+async_engine = create_async_engine(
+    get_database_url(), **(ENGINE_OPTIONS | {"pool_size": 10, "max_overflow": 10})
+)
+
+AsyncSessionLocal: async_sessionmaker[AsyncSession] = async_sessionmaker(
+    async_engine, autoflush=False, expire_on_commit=False
+)
+
+
+def _with_options[T](
+    stmt: Select[tuple[T]],
+    options: Sequence[ORMOption],
+    only: Sequence[InstrumentedAttribute[Any]],
+) -> Select[tuple[T]]:
+    """
+    selectinload などのローダーオプションを付与する
+    リレーションは lazy="raise_on_sql" なので、参照するものはここで明示的に読み込む
+    only を指定した場合は、そのカラム (と主キー) だけを SELECT する
+    それ以外のカラムは読み込まれず、セッションを閉じた後は参照できない (sa_to_dict の結果にも含まれない)
+    """
+    if options:
+        stmt = stmt.options(*options)
+    if only:
+        stmt = stmt.options(load_only(*only))
+    return stmt
+
+
+def fetch_all[T](
+    stmt: Select[tuple[T]],
+    *,
+    options: Sequence[ORMOption] = (),
+    only: Sequence[InstrumentedAttribute[Any]] = (),
+) -> Sequence[T]:
+    stmt = _with_options(stmt, options, only)
+    with SessionLocal() as session:
         return session.scalars(stmt).all()
 
 
-def fetch_first[T](stmt: Select[tuple[T]]) -> T | None:
+def fetch_first[T](
+    stmt: Select[tuple[T]],
+    *,
+    options: Sequence[ORMOption] = (),
+    only: Sequence[InstrumentedAttribute[Any]] = (),
+) -> T | None:
     """
     取得した結果の最初の1件のみを返す
     0件の場合 None を返す
     """
-    with Session(engine) as session:
+    stmt = _with_options(stmt, options, only)
+    with SessionLocal() as session:
         return session.scalars(stmt).first()
 
 
-def fetch_one[T](stmt: Select[tuple[T]]) -> T:
+def fetch_one[T](
+    stmt: Select[tuple[T]],
+    *,
+    options: Sequence[ORMOption] = (),
+    only: Sequence[InstrumentedAttribute[Any]] = (),
+) -> T:
     """
     取得した結果がちょうど1件のときのみ返す
     0件の場合はエラー (NoResultFound)
     2件以上の場合はエラー (MultipleResultsFound)
     """
-    with Session(engine) as session:
+    stmt = _with_options(stmt, options, only)
+    with SessionLocal() as session:
         return session.scalars(stmt).one()
 
 
-def fetch_one_or_none[T](stmt: Select[tuple[T]]) -> T | None:
+def fetch_one_or_none[T](
+    stmt: Select[tuple[T]],
+    *,
+    options: Sequence[ORMOption] = (),
+    only: Sequence[InstrumentedAttribute[Any]] = (),
+) -> T | None:
     """
     取得した結果がちょうど1件のとき返す
     0件の場合は None を返す
     2件以上の場合はエラー (MultipleResultsFound)
     """
-    with Session(engine) as session:
+    stmt = _with_options(stmt, options, only)
+    with SessionLocal() as session:
         return session.scalars(stmt).one_or_none()
+
+
+def fetch_iter[T](
+    stmt: Select[tuple[T]],
+    *,
+    options: Sequence[ORMOption] = (),
+    only: Sequence[InstrumentedAttribute[Any]] = (),
+    yield_per: int = 1000,
+) -> Iterator[T]:
+    """
+    取得した結果を yield_per 件ずつサーバーサイドカーソルで読み込みながら返す
+    最後まで読み切るか close() するまでセッション (DB 接続) を保持し続ける
+    """
+    stmt = _with_options(stmt, options, only).execution_options(yield_per=yield_per)
+    with SessionLocal() as session:
+        yield from session.scalars(stmt)
+
+
+# cached_fetch_all 用のキャッシュ: キー -> (有効期限, 結果)
+_result_cache: dict[Hashable, tuple[float, Sequence[Any]]] = {}
+_RESULT_CACHE_MAXSIZE = 1024
+
+
+def cached_fetch_all[T](
+    stmt: Select[tuple[T]],
+    *,
+    options: Sequence[ORMOption] = (),
+    only: Sequence[InstrumentedAttribute[Any]] = (),
+    ttl: float = 60,
+) -> Sequence[T]:
+    """
+    fetch_all の結果を ttl 秒間キャッシュする
+    insert_many / update_many で書き込むとキャッシュは破棄されるが、それ以外の書き込みは検知できない
+    """
+    stmt = _with_options(stmt, options, only)
+    cache_key = stmt._generate_cache_key()
+    if cache_key is None:  # キャッシュできない文
+        return fetch_all(stmt)
+
+    # 文の構造 (ローダーオプションも含む) とバインドパラメータの値をキーにする
+    key = (cache_key.key, repr([p.effective_value for p in cache_key.bindparams]))
+    now = monotonic()
+    if (cached := _result_cache.get(key)) and cached[0] > now:
+        return cached[1]
+
+    result = fetch_all(stmt)
+    if len(_result_cache) >= _RESULT_CACHE_MAXSIZE:
+        _result_cache.pop(next(iter(_result_cache)))  # 一番古いものを捨てる
+    _result_cache[key] = (now + ttl, result)
+    return result
+
+
+def insert_many(
+    model: type[DeclarativeBase],
+    rows: Sequence[Mapping[str, Any]],
+    *,
+    chunk_size: int = 1000,
+) -> None:
+    """
+    複数行をまとめて INSERT する
+    chunk_size 行ごとに複数 VALUES の INSERT 文を発行し、最後に1回だけ COMMIT する
+    """
+    with SessionLocal.begin() as session:
+        for chunk in batched(rows, chunk_size, strict=False):
+            # タプルのままだと1行分のパラメータとして解釈されるので list で渡す
+            session.execute(insert(model), list(chunk))
+    _result_cache.clear()
+
+
+def update_many(
+    model: type[DeclarativeBase],
+    rows: Sequence[Mapping[str, Any]],
+    *,
+    chunk_size: int = 1000,
+) -> None:
+    """
+    複数行をまとめて主キーで UPDATE する
+    各行には主キーのカラムを含める必要がある
+    """
+    with SessionLocal.begin() as session:
+        for chunk in batched(rows, chunk_size, strict=False):
+            # タプルのままだと1行分のパラメータとして解釈されるので list で渡す
+            session.execute(update(model), list(chunk))
+    _result_cache.clear()
+
+
+async def async_fetch_all[T](
+    stmt: Select[tuple[T]],
+    *,
+    options: Sequence[ORMOption] = (),
+    only: Sequence[InstrumentedAttribute[Any]] = (),
+) -> Sequence[T]:
+    """fetch_all の非同期版"""
+    stmt = _with_options(stmt, options, only)
+    async with AsyncSessionLocal() as session:
+        return (await session.scalars(stmt)).all()
+
+
+async def async_fetch_first[T](
+    stmt: Select[tuple[T]],
+    *,
+    options: Sequence[ORMOption] = (),
+    only: Sequence[InstrumentedAttribute[Any]] = (),
+) -> T | None:
+    """fetch_first の非同期版"""
+    stmt = _with_options(stmt, options, only)
+    async with AsyncSessionLocal() as session:
+        return (await session.scalars(stmt)).first()
+
+
+async def async_fetch_one[T](
+    stmt: Select[tuple[T]],
+    *,
+    options: Sequence[ORMOption] = (),
+    only: Sequence[InstrumentedAttribute[Any]] = (),
+) -> T:
+    """fetch_one の非同期版"""
+    stmt = _with_options(stmt, options, only)
+    async with AsyncSessionLocal() as session:
+        return (await session.scalars(stmt)).one()
+
+
+async def async_fetch_one_or_none[T](
+    stmt: Select[tuple[T]],
+    *,
+    options: Sequence[ORMOption] = (),
+    only: Sequence[InstrumentedAttribute[Any]] = (),
+) -> T | None:
+    """fetch_one_or_none の非同期版"""
+    stmt = _with_options(stmt, options, only)
+    async with AsyncSessionLocal() as session:
+        return (await session.scalars(stmt)).one_or_none()
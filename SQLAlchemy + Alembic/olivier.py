@@ -1,7 +1,15 @@
+import ast
 import inspect
+import os
+import sys
 from collections import defaultdict
-from copy import deepcopy
-from types import UnionType
+from collections.abc import Callable
+from functools import cache
+from hashlib import blake2b
+from importlib.util import module_from_spec, spec_from_file_location
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from types import ModuleType, UnionType
 from typing import (
     Any,
     NotRequired,
@@ -40,16 +48,17 @@ class ModelDefinition(TypedDict):
 
 
 def build_model_definitions(models: list[ModelDefinition]) -> str:
-    def type_ref(t: TypeInfo) -> str:
-        ref = t.get("alias", t["name"])
+    def type_expr(t: TypeInfo) -> ast.expr:
+        expr: ast.expr = ast.Name(t.get("alias", t["name"]))
         if t.get("list"):
-            ref = f"list[{ref}]"
+            expr = ast.Subscript(ast.Name("list"), expr)
         if t.get("optional"):
-            ref = f"{ref} | None"
-        return ref
+            expr = ast.BinOp(expr, ast.BitOr(), ast.Constant(None))
+        return expr
 
-    # Collect imports: module -> {(name, alias)}
+    # Collect imports (module -> {(name, alias)}) while building class nodes
     imports: dict[str, set[tuple[str, str | None]]] = defaultdict(set)
+    classes: list[ast.stmt] = []
 
     for m in models:
         # base type import (e.g., BaseModel from pydantic)
@@ -57,116 +66,123 @@ def build_model_definitions(models: list[ModelDefinition]) -> str:
         if base and (import_from := base.get("import_from")):
             imports[import_from].add((base["name"], base.get("alias")))
 
-        # field type imports
-        for field in m["fields"]:
-            _type = field["type"]
-            if import_from := _type.get("import_from"):
-                imports[import_from].add((_type["name"], _type.get("alias")))
-
-    # Render imports in a deterministic order
-    import_lines: list[str] = []
-    for module in sorted(imports.keys()):
-        items = sorted(imports[module], key=lambda x: (x[0], x[1] or ""))
-        parts = []
-        for name, alias in items:
-            parts.append(f"{name} as {alias}" if alias else name)
-        import_lines.append(f"from {module} import {', '.join(parts)}")
-
-    # Render classes
-    class_lines: list[str] = []
-    for m in models:
-        base = m.get("base")
-        base_name = type_ref(base) if base else "BaseModel"
-
-        # Add BaseModel import if base is not specified
+        # BaseModel import if base is not specified
         if not base:
-            imports.setdefault("pydantic", set()).add(("BaseModel", None))
+            imports["pydantic"].add(("BaseModel", None))
 
-        class_lines.append(f"class {m['name']}({base_name}):")
+        body: list[ast.stmt] = []
 
         # Add description as docstring if present
         description = m.get("description")
         if description:
-            class_lines.append(f'    """{description}"""')
-            class_lines.append("")
-
-        # Add config
-        config_items = []
-        for key, value in m["config"].items():
-            if isinstance(value, str):
-                config_items.append(f"{key}='{value}'")
-            else:
-                config_items.append(f"{key}={value!r}")
-        if len(config_items) > 0:
-            config_str = ", ".join(config_items)
-            class_lines.append(f"    model_config = ConfigDict({config_str})")
-            class_lines.append("")
-            # Add ConfigDict import
-            imports.setdefault("pydantic", set()).add(("ConfigDict", None))
-
-        # Add fields
+            body.append(ast.Expr(ast.Constant(description)))
+
+        # Add config (and ConfigDict import)
+        if m["config"]:
+            imports["pydantic"].add(("ConfigDict", None))
+            keywords = [
+                ast.keyword(key, ast.parse(repr(value), mode="eval").body)
+                for key, value in m["config"].items()
+            ]
+            body.append(
+                ast.Assign(
+                    targets=[ast.Name("model_config")],
+                    value=ast.Call(ast.Name("ConfigDict"), args=[], keywords=keywords),
+                )
+            )
+
+        # Add fields (and field type imports)
         for field in m["fields"]:
-            line = f"    {field['name']}: {type_ref(field['type'])}"
-            if default := field.get("default"):
-                line += f" = {default}"
-            class_lines.append(line)
-
-        class_lines.append("")  # blank line after each class
+            _type = field["type"]
+            if import_from := _type.get("import_from"):
+                imports[import_from].add((_type["name"], _type.get("alias")))
 
-    # Re-render imports if ConfigDict or BaseModel was added
-    import_lines = []
+            default = field.get("default")
+            body.append(
+                ast.AnnAssign(
+                    target=ast.Name(field["name"]),
+                    annotation=type_expr(_type),
+                    value=ast.parse(default, mode="eval").body if default else None,
+                    simple=1,
+                )
+            )
+
+        classes.append(
+            ast.ClassDef(
+                name=m["name"],
+                bases=[type_expr(base) if base else ast.Name("BaseModel")],
+                keywords=[],
+                body=body or [ast.Pass()],
+                decorator_list=[],
+            )
+        )
+
+    # Imports in a deterministic order
+    import_nodes: list[ast.stmt] = []
     for module in sorted(imports.keys()):
         items = sorted(imports[module], key=lambda x: (x[0], x[1] or ""))
-        parts = []
-        for name, alias in items:
-            parts.append(f"{name} as {alias}" if alias else name)
-        import_lines.append(f"from {module} import {', '.join(parts)}")
-
-    # Join (imports, blank line, classes). Match the sample formatting.
-    out: list[str] = []
-    out.extend(import_lines)
-    if import_lines:
-        out.append("")  # blank line between imports and first class
-    out.extend(class_lines)
-
-    # Avoid extra blank lines at the very end (sample ends without an extra blank line)
-    while out and out[-1] == "":
-        out.pop()
-
-    return "\n".join(out)
+        names = [ast.alias(name, alias) for name, alias in items]
+        import_nodes.append(ast.ImportFrom(module=module, names=names, level=0))
+
+    tree = ast.Module(body=[*import_nodes, *classes], type_ignores=[])
+    ast.fix_missing_locations(tree)
+    return ast.unparse(tree)
+
+
+MODELS_CACHE_DIR = Path(__file__).with_name(".olivier_cache")
+
+
+def load_models(code: str, *, cache_dir: Path = MODELS_CACHE_DIR) -> ModuleType:
+    """
+    build_model_definitions で生成したコードをモジュールとして読み込む
+    コードのハッシュをファイル名にして保存するので、同じコードなら2回目以降はバイトコードのキャッシュ (.pyc) が使われる
+    """
+    name = f"_olivier_{blake2b(code.encode(), digest_size=16).hexdigest()}"
+    if module := sys.modules.get(name):
+        return module
+
+    path = cache_dir / f"{name}.py"
+    if not path.exists():
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        # 同時に書き込むプロセスと衝突しないよう、一意な一時ファイルに書いてから置き換える
+        with NamedTemporaryFile(
+            "w", encoding="utf-8", dir=cache_dir, suffix=".tmp", delete=False
+        ) as f:
+            f.write(code)
+        os.replace(f.name, path)
+
+    spec = spec_from_file_location(name, path)
+    assert spec and spec.loader
+    module = module_from_spec(spec)
+    # Pydantic が前方参照を解決できるよう、実行前に登録しておく
+    sys.modules[name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[name]
+        raise
+    return module
 
 
 def detect_typeinfo(t: Any) -> TypeInfo:
     """型オブジェクトから型情報 (TypeInfo) を抽出する"""
-    origin = get_origin(t)
-    args = get_args(t)
-
-    if origin is Mapped:
-        inner_type = args[0]
-        return detect_typeinfo(inner_type)
+    try:
+        info = _detect_typeinfo(t)
+    except TypeError:  # ハッシュできない型はキャッシュせずに解析する
+        info = _detect_typeinfo.__wrapped__(t)
+    # 呼び出し側で書き換えられるので、キャッシュとは別の dict を返す
+    return info.copy()
 
-    # Union
-    if origin is Union or origin is UnionType:
-        non_none_args = [arg for arg in args if arg is not type(None)]
-        optional = type(None) in args
 
-        # None 以外の型が複数ある Union は未対応
-        if len(non_none_args) > 1:
-            raise NotImplementedError
-
-        result = detect_typeinfo(non_none_args[0])
-        if optional:
-            result["optional"] = True
-        return result
+@cache
+def _detect_typeinfo(t: Any) -> TypeInfo:
+    # Mapped / Union / list / dict などのジェネリック型は origin で振り分ける
+    if handler := _ORIGIN_HANDLERS.get(get_origin(t)):
+        return handler(get_args(t))
 
     if t is type(None):
         return {"name": "None"}
 
-    if origin is list:
-        t = detect_typeinfo(args[0])
-        t["list"] = True
-        return t
-
     # TypedDict
     if hasattr(t, "__annotations__"):
         module = t.__module__
@@ -176,9 +192,6 @@ def detect_typeinfo(t: Any) -> TypeInfo:
             return {"name": name}
         return {"name": name, "import_from": module}
 
-    if origin is dict:
-        return {"name": "dict"}
-
     if inspect.isclass(t):
         module = t.__module__
         name = t.__qualname__
@@ -197,6 +210,49 @@ def detect_typeinfo(t: Any) -> TypeInfo:
     return {"name": str(t)}
 
 
+def _detect_mapped_typeinfo(args: tuple[Any, ...]) -> TypeInfo:
+    return detect_typeinfo(args[0])
+
+
+def _detect_union_typeinfo(args: tuple[Any, ...]) -> TypeInfo:
+    non_none_args = [arg for arg in args if arg is not type(None)]
+    optional = type(None) in args
+
+    # None 以外の型が複数ある Union は未対応
+    if len(non_none_args) > 1:
+        raise NotImplementedError
+
+    result = detect_typeinfo(non_none_args[0])
+    if optional:
+        result["optional"] = True
+    return result
+
+
+def _detect_list_typeinfo(args: tuple[Any, ...]) -> TypeInfo:
+    result = detect_typeinfo(args[0])
+    result["list"] = True
+    return result
+
+
+def _detect_dict_typeinfo(args: tuple[Any, ...]) -> TypeInfo:
+    return {"name": "dict"}
+
+
+_ORIGIN_HANDLERS: dict[Any, Callable[[tuple[Any, ...]], TypeInfo]] = {
+    Mapped: _detect_mapped_typeinfo,
+    Union: _detect_union_typeinfo,
+    UnionType: _detect_union_typeinfo,
+    list: _detect_list_typeinfo,
+    dict: _detect_dict_typeinfo,
+}
+
+
+@cache
+def _type_hints(cls: type) -> dict[str, Any]:
+    """get_type_hints はアノテーションの評価を伴い重いので、クラスごとにキャッシュする"""
+    return get_type_hints(cls)
+
+
 def sqlalchemy_model_to_pydantic_model_definition(
     cls: type[DeclarativeBase],
     name: str | None = None,
@@ -209,7 +265,7 @@ def sqlalchemy_model_to_pydantic_model_definition(
     if type(name) is not str:
         raise ValueError("name is not specified")
 
-    type_hints = get_type_hints(cls)
+    type_hints = _type_hints(cls)
     for col in mapper.columns:
         t = detect_typeinfo(type_hints.get(col.name, col.type.python_type))
         if col.nullable:
@@ -232,6 +288,21 @@ def sqlalchemy_model_to_pydantic_model_definition(
     }
 
 
+def _clone_model_definition(md: ModelDefinition) -> ModelDefinition:
+    """
+    ModelDefinition をコピーする
+    中身は dict / list / str などだけなので、deepcopy を使わずに必要な階層だけコピーする
+    """
+    clone = md.copy()
+    clone["fields"] = [
+        {**field, "type": field["type"].copy()} for field in md["fields"]
+    ]
+    clone["config"] = md["config"].copy()
+    if base := md.get("base"):
+        clone["base"] = base.copy()
+    return clone
+
+
 def create_partial(
     base: ModelDefinition,
     name: str | None = None,
@@ -242,7 +313,7 @@ def create_partial(
     required: set[str] | None = None,  # 指定したフィールドの Optional を外す
     optional: set[str] | None = None,  # 指定したフィールドを Optional にする
 ) -> ModelDefinition:
-    model = deepcopy(base)
+    model = _clone_model_definition(base)
 
     if name:
         model["name"] = name
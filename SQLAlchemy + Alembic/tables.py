@@ -83,12 +83,14 @@ class UserTable(BaseTable, TimestampMixin):
     )
 
     articles: Mapped[list[ArticleTable]] = relationship(
+        lazy="raise_on_sql",
         back_populates="author",
         cascade="all, delete-orphan",
         passive_deletes=True,
     )
 
     comments: Mapped[list[CommentTable]] = relationship(
+        lazy="raise_on_sql",
         back_populates="author",
         cascade="all, delete-orphan",
         passive_deletes=True,
@@ -123,10 +125,12 @@ class ArticleTable(BaseTable, TimestampMixin):
 
     # relationships
     author: Mapped[UserTable] = relationship(
+        lazy="raise_on_sql",
         back_populates="articles",
     )
 
     comments: Mapped[list[CommentTable]] = relationship(
+        lazy="raise_on_sql",
         back_populates="article",
         cascade="all, delete-orphan",
         passive_deletes=True,
@@ -158,9 +162,11 @@ class CommentTable(BaseTable, TimestampMixin):
 
     # relationships
     article: Mapped[ArticleTable] = relationship(
+        lazy="raise_on_sql",
         back_populates="comments",
     )
 
     author: Mapped[UserTable] = relationship(
+        lazy="raise_on_sql",
         back_populates="comments",
     )
@@ -1,7 +1,9 @@
 import subprocess
+from functools import cache
 from hashlib import pbkdf2_hmac
 from os import environ
-from tempfile import NamedTemporaryFile
+from pathlib import Path
+from tempfile import TemporaryDirectory, TemporaryFile
 from typing import Any, overload
 
 from sqlalchemy import inspect
@@ -24,26 +26,91 @@ def ruff_format(
     isort: bool = True,
     line_length: int | None = None,
 ) -> str:
-    run_options: dict[str, Any] = {"text": True, "capture_output": True, "check": True}
-
-    # isort
-    if isort:
-        with NamedTemporaryFile("w+", suffix=".py") as f:
-            f.write(code)
-            f.flush()
-            cmd = [ruff_command, "check", "--isolated", "--fix"]
-            cmd += ["--select", "I"]  # isort
-            subprocess.run(cmd + [f.name], **run_options)
-            f.seek(0)
-            code = f.read()
-
-    # format
     cmd = [ruff_command, "format", "--isolated"]
     if line_length:
         cmd += ["--line-length", str(line_length)]
-    code = subprocess.run(cmd + ["-"], input=code, **run_options).stdout
+    cmd += ["-"]
+
+    if not isort:
+        return subprocess.run(
+            cmd, input=code, text=True, capture_output=True, check=True
+        ).stdout
+
+    # isort の出力をパイプで format に渡し、2つの ruff を同時に起動する
+    isort_cmd = [ruff_command, "check", "--isolated", "--fix"]
+    isort_cmd += ["--select", "I"]  # isort
+    isort_cmd += ["-"]
+    # isort の stderr はパイプにすると読まれずに詰まることがあるので、一時ファイルに受ける
+    with (
+        TemporaryFile("w+") as isort_stderr,
+        subprocess.Popen(
+            isort_cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=isort_stderr,
+            text=True,
+        ) as isort_proc,
+        subprocess.Popen(
+            cmd,
+            stdin=isort_proc.stdout,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        ) as format_proc,
+    ):
+        assert isort_proc.stdin and isort_proc.stdout
+        isort_proc.stdout.close()  # format 側だけが読むようにする
+        # ruff は stdin を読み切ってから出力するので、書き込みでは詰まらない
+        isort_proc.stdin.write(code)
+        isort_proc.stdin.close()
+        stdout, stderr = format_proc.communicate()
+        isort_proc.wait()
+
+        if isort_proc.returncode:
+            isort_stderr.seek(0)
+            raise subprocess.CalledProcessError(
+                isort_proc.returncode, isort_cmd, None, isort_stderr.read()
+            )
+
+    if format_proc.returncode:
+        raise subprocess.CalledProcessError(format_proc.returncode, cmd, stdout, stderr)
+
+    return stdout
+
+
+def ruff_format_many(
+    codes: list[str],
+    *,
+    ruff_command: str = "ruff",
+    isort: bool = True,
+    line_length: int | None = None,
+) -> list[str]:
+    """
+    複数のコードをまとめてフォーマットする
+    コードごとに一時ディレクトリ内の別ファイルに書き出し、ディレクトリ単位で ruff を1回ずつ実行する
+    (ファイル単位なので `# fmt: off` などのディレクティブが他のコードに影響しない)
+    """
+    if not codes:
+        return []
+
+    with TemporaryDirectory() as tmpdir:
+        paths = [Path(tmpdir) / f"{idx:06d}.py" for idx in range(len(codes))]
+        for path, code in zip(paths, codes, strict=True):
+            path.write_text(code, encoding="utf-8", newline="")
+
+        # isort
+        if isort:
+            cmd = [ruff_command, "check", "--isolated", "--fix"]
+            cmd += ["--select", "I"]  # isort
+            subprocess.run(cmd + [tmpdir], capture_output=True, check=True)
 
-    return code
+        # format
+        cmd = [ruff_command, "format", "--isolated"]
+        if line_length:
+            cmd += ["--line-length", str(line_length)]
+        subprocess.run(cmd + [tmpdir], capture_output=True, check=True)
+
+        return [path.read_text(encoding="utf-8", newline="") for path in paths]
 
 
 @overload
@@ -55,25 +122,81 @@ def sa_to_dict(obj: None) -> None: ...
 
 
 def sa_to_dict(obj: DeclarativeBase | None) -> dict[str, Any] | None:
-    """SQLAlchemy オブジェクトを dict に変換する"""
+    """
+    SQLAlchemy オブジェクトを dict に変換する
+    読み込まれていないカラムはセッションにあれば読み込み、セッションから切り離されていれば含めない
+    読み込まれていないリレーションは含めない
+    変換中の親オブジェクトを指す逆参照は含めない (コレクションからはその要素だけを除く)
+    逆参照を省いた dict は辿った経路によって内容が変わるので、共有されたオブジェクトでも使い回さない
+    """
     if obj is None:
         return None
-
-    info = inspect(obj)
-    data: dict[str, Any] = {}
-
-    for col in info.mapper.column_attrs:
-        data[col.key] = getattr(obj, col.key)
-
-    for rel in info.mapper.relationships:
-        if rel.key in info.unloaded:
+    return _sa_to_dict(obj, {}, set())[0]
+
+
+def _sa_to_dict(
+    obj: DeclarativeBase, seen: dict[int, dict[str, Any]], path: set[int]
+) -> tuple[dict[str, Any], bool]:
+    """(変換した dict, 逆参照を1つも省かずに変換できたか) を返す"""
+    # 変換済みのオブジェクトは同じ dict を使い回す (複数から参照されるオブジェクトを何度も変換しないように)
+    if (data := seen.get(id(obj))) is not None:
+        return data, True
+    data = {}
+    complete = True
+    # 変換中 (再帰の途中) のオブジェクト。ここを指すリレーションは逆参照なので含めない
+    path.add(id(obj))
+
+    columns, relationships = _mapped_attrs(type(obj))
+    # 読み込み済みの値は __dict__ に入っているので、属性アクセスの計装を経由せずに読む
+    loaded = obj.__dict__
+
+    detached: bool | None = None
+    for key in columns:
+        if key in loaded:
+            data[key] = loaded[key]
             continue
-        value = getattr(obj, rel.key)
+        # 未ロード (期限切れ・load_only などで読み込んでいないカラム)
+        # セッションにあれば getattr で読み込み、切り離されていて読み込めなければ含めない
+        if detached is None:
+            detached = inspect(obj).detached
+        if not detached:
+            data[key] = getattr(obj, key)
+
+    for key, uselist in relationships:
+        if key not in loaded:  # 未ロード
+            continue
+        value = loaded[key]
         if value is None:
-            data[rel.key] = None
-        elif rel.uselist:
-            data[rel.key] = [sa_to_dict(x) for x in value]
+            data[key] = None
+        elif uselist:
+            items = []
+            for x in value:
+                if id(x) in path:  # 逆参照
+                    complete = False
+                    continue
+                item, item_complete = _sa_to_dict(x, seen, path)
+                items.append(item)
+                complete &= item_complete
+            data[key] = items
+        elif id(value) in path:  # 逆参照
+            complete = False
         else:
-            data[rel.key] = sa_to_dict(value)
-
-    return data
+            data[key], value_complete = _sa_to_dict(value, seen, path)
+            complete &= value_complete
+
+    path.discard(id(obj))
+    # 省いた逆参照はどの経路で辿ったかによって変わるので、何も省いていない dict だけを使い回す
+    if complete:
+        seen[id(obj)] = data
+    return data, complete
+
+
+@cache
+def _mapped_attrs(
+    cls: type[DeclarativeBase],
+) -> tuple[tuple[str, ...], tuple[tuple[str, bool], ...]]:
+    """モデルクラスのカラム名と (リレーション名, uselist) の一覧"""
+    mapper = inspect(cls)
+    columns = tuple(col.key for col in mapper.column_attrs)
+    relationships = tuple((rel.key, bool(rel.uselist)) for rel in mapper.relationships)
+    return columns, relationships